@@ -2,18 +2,66 @@
 Subscription Tracker - FastAPI + OpenRouter/Gemini Flash with Structured Outputs
 """
 
-import os, uuid, pdfplumber
-from io import BytesIO
+import os, re, sys, uuid, shutil, asyncio, time, codecs, hashlib, tempfile, httpx, orjson, pymupdf
+import redis.asyncio as redis
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
 from pathlib import Path
+from typing import BinaryIO
 from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from openrouter import OpenRouter
-from pydantic import BaseModel, Field
+from jinja2 import FileSystemBytecodeCache
+from pydantic import BaseModel, Field, ValidationError
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One client for the whole process: TCP+TLS to OpenRouter is set up once, and concurrent
+    # LLM calls are multiplexed over HTTP/2 instead of each opening a connection
+    app.state.http = httpx.AsyncClient(
+        http2=True, timeout=httpx.Timeout(120, connect=10),
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300)
+    )
+    yield
+    await app.state.http.aclose()
+    if store: await store.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
+
+# Sessions go to Redis when REDIS_URL is set so every worker sees them; otherwise a per-process dict (dev)
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = 3600
+store = redis.from_url(REDIS_URL) if REDIS_URL else None
 sessions: dict = {}
+# uvicorn worker processes (see __main__); without Redis, sessions live in process memory so default to one
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) if REDIS_URL else 1)))
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+MODEL = "google/gemini-2.0-flash-001"
+PROMPT_VERSION = "v5"  # bump whenever PROMPT, the message layout, or the output schema changes
+MAX_CHARS = 50000  # statement text sent to the LLM is truncated to this
+RAW_CHARS = MAX_CHARS * 4  # raw text extracted per file; _compact() then drops headers/footers before the cut
+CHUNK = 64 * 1024
+HIT_AMOUNTS = 6  # amounts listed per pre-detected service
+LLM_ATTEMPTS = 3  # invalid JSON/schema responses are retried with the validation error as feedback
+# Keep layout whitespace, ignore off-page text; ligatures are expanded ("ﬁ" -> "fi") so merchant regexes match,
+# and unmappable glyphs become U+FFFD instead of raw CIDs
+TEXT_FLAGS = pymupdf.TEXT_PRESERVE_WHITESPACE | pymupdf.TEXT_MEDIABOX_CLIP
+# Opt-in: when set, validated LLM output (plaintext subscription data) is cached in this directory
+CACHE_DIR = os.getenv("SUBTRACKER_CACHE_DIR", "")
+
+# With a cache dir, compiled templates survive restarts; in production also skip the per-render mtime check
+if CACHE_DIR:
+    try:
+        Path(CACHE_DIR, "jinja").mkdir(parents=True, exist_ok=True)
+        templates.env.bytecode_cache = FileSystemBytecodeCache(str(Path(CACHE_DIR, "jinja")))
+    except OSError as e:
+        print(f"Template cache disabled: {e}")
+templates.env.auto_reload = os.getenv("SUBTRACKER_ENV") != "production"
 
 
 # Pydantic models for structured LLM output
@@ -30,8 +78,16 @@ class SubscriptionList(BaseModel):
     subscriptions: list[SubscriptionItem] = Field(description="List of ALL recurring subscriptions found")
 
 
-# Internal model with computed fields
-class Sub(BaseModel):
+# Structured-output response_format, built once instead of per request
+_SUBS_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {"name": "subscriptions", "strict": True, "schema": SubscriptionList.model_json_schema()}
+}
+
+
+# Internal model with computed fields (plain slotted dataclass: no validation needed on our own data)
+@dataclass(slots=True, frozen=True)
+class Sub:
     id: str
     name: str
     amount: float
@@ -42,103 +98,264 @@ class Sub(BaseModel):
     monthly: float = 0.0
     yearly: float = 0.0
     cancel_url: str = ""
+    # Display strings, formatted once here rather than by Jinja on every render (frozen, so they can't go stale)
+    monthly_s: str = field(init=False)
+    yearly_s: str = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "monthly_s", f"{self.monthly:,.2f}")
+        object.__setattr__(self, "yearly_s", f"{self.yearly:,.2f}")
+
+
+# Stored session fields: the derived display strings are left out so Sub(**blob) round-trips
+_SESSION_FIELDS = [f.name for f in fields(Sub) if f.init]
 
 
-PROMPT = """Extract ALL recurring subscriptions from this bank statement.
+# Sent verbatim as the system message: keep it free of per-request data (dates, ids) so it stays cacheable
+PROMPT = """Extract ALL recurring subscriptions from the user's bank statement.
 
 Known services (with cancel URLs):
-- Netflix (netflix.com/cancelplan), Spotify (spotify.com/account), YouTube Premium, Hulu, Disney+, HBO Max, Amazon Prime (amazon.com/prime/manage), Apple/iCloud (apple.com/account)
+- Netflix (netflix.com/cancelplan), Spotify (spotify.com/account), YouTube Premium, Hulu, Disney+, HBO Max, Paramount+, Peacock, Crunchyroll, Amazon Prime (amazon.com/prime/manage), Apple/iCloud (apple.com/account)
 - ChatGPT Plus (chat.openai.com/settings), Claude Pro (claude.ai/settings), GitHub (github.com/settings/billing), Cursor, Midjourney
 - Notion (notion.so/my-account), Dropbox, Adobe (account.adobe.com), Microsoft 365, 1Password, Google One
 - X Premium, Discord Nitro (discord.com/settings/subscriptions), LinkedIn Premium
-- NYTimes, WSJ, Substack, Planet Fitness, Equinox, Peloton, ClassPass
+- NYTimes, WSJ, Substack, Patreon, Audible, Duolingo, Planet Fitness, Equinox, Peloton, ClassPass
 
 Include EVERY recurring subscription. Do not skip any.
-
-Bank statement:
 """
+_PROMPT_BYTES = PROMPT.encode()
 
+# (monthly, yearly) multipliers per billing frequency; anything unrecognised is treated as weekly
+FREQ_FACTORS = {"monthly": (1.0, 12.0), "yearly": (1/12, 1.0), "weekly": (4.33, 52.0)}
 
-def parse(content: bytes, filename: str) -> list[Sub] | str:
-    """Returns list of subscriptions, or error string"""
-    # Extract text
+
+# Known services -> how their charges show up on card statements; listed in the prompt as pre-detected hits.
+# Only subscription-specific descriptors belong here: bare brand names (amazon, apple, google) also match
+# ordinary purchases, so they live in BRANDS and only feed the skip-LLM check
+SERVICES = {
+    "Netflix": "netflix", "Spotify": "spotify", "YouTube Premium": r"youtube ?(?:premium|music|tv)",
+    "Hulu": "hulu", "Disney+": r"disney ?plus|disney\+", "HBO Max": r"hbo ?(?:max|now)|max\.com",
+    "Amazon Prime": r"amazon prime|amzn prime|prime video|prime membership", "Apple/iCloud": r"apple\.com/bill|icloud|itunes",
+    "ChatGPT Plus": "chatgpt|openai", "Claude Pro": "claude|anthropic", "GitHub": "github", "Cursor": "cursor",
+    "Midjourney": "midjourney", "Notion": "notion", "Dropbox": "dropbox", "Adobe": "adobe",
+    "Microsoft 365": "microsoft ?365|msft ?365", "1Password": "1password", "Google One": r"google \*?one|google storage",
+    "X Premium": "x corp|twitter", "Discord Nitro": "discord", "LinkedIn Premium": "linkedin",
+    "NYTimes": "nytimes|ny times", "WSJ": "wsj|dow jones", "Substack": "substack", "Planet Fitness": "planet fitness",
+    "Equinox": "equinox", "Peloton": "peloton", "ClassPass": "classpass", "Patreon": "patreon", "Audible": "audible",
+    "Paramount+": r"paramount ?(?:\+|plus)", "Peacock": "peacock ?(?:tv|premium)", "Crunchyroll": "crunchyroll", "Duolingo": "duolingo",
+}
+_SERVICE_NAMES = list(SERVICES)
+# One alternation over every service; the matching group's index (s0, s1, ...) identifies which one hit.
+# Whole words only ((?!\w) rather than \b so patterns may end in "+"): "APPLEBEES" or "DISNEYLAND" don't count
+MERCHANTS = re.compile(
+    r"\b(?:" + "|".join(f"(?P<s{i}>{p})" for i, p in enumerate(SERVICES.values())) + r")(?!\w)", re.IGNORECASE
+)
+BRANDS = re.compile(r"\b(amazon|amzn|apple|google|microsoft|msft)(?!\w)", re.IGNORECASE)
+RECURRING = re.compile(r"\b(subscr|membership|recurring|premium|monthly)", re.IGNORECASE)  # prefixes: "subscr" -> "subscription"
+AMOUNT = re.compile(r"\b(?:\d{1,3}(?:,\d{3})+|\d+)\.\d{2}\b")
+
+# A date (01/15, 2024-01-15, Jan 15) followed later on the same line by an amount (15.99)
+TXN_LINE = re.compile(
+    r"(\b\d{1,2}[/-]\d{1,2}\b|\b(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.? \d{1,2}\b).*\d\.\d{2}\b",
+    re.IGNORECASE,
+)
+
+
+def _cache_key(file: BinaryIO) -> str:
+    """SHA-256 over (model, prompt version, length-prefixed content, prompt)"""
+    h = hashlib.sha256(f"{PROMPT_VERSION}\x00{MODEL}\x00".encode())
+    h.update(file.seek(0, os.SEEK_END).to_bytes(8, "little"))
+    file.seek(0)
+    while chunk := file.read(CHUNK): h.update(chunk)
+    h.update(_PROMPT_BYTES)
+    return h.hexdigest()
+
+
+def _cache_get(key: str) -> SubscriptionList | None:
+    if not CACHE_DIR: return None
+    path = Path(CACHE_DIR, key + ".json")
+    try: raw = path.read_bytes()
+    except OSError: return None
+    try: return SubscriptionList.model_validate_json(raw)
+    except ValidationError:  # stale schema or corrupt entry: evict and re-run the LLM
+        path.unlink(missing_ok=True)
+        return None
+
+
+def _cache_put(key: str, data: SubscriptionList):
+    if not CACHE_DIR: return
+    try:
+        Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+        entry = {"model": MODEL, "prompt_version": PROMPT_VERSION, "ts": time.time(), **data.model_dump()}
+        tmp = Path(CACHE_DIR, f"{key}.{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(orjson.dumps(entry))
+        os.replace(tmp, Path(CACHE_DIR, key + ".json"))  # atomic: readers never see a partial file
+    except OSError as e:
+        print(f"Cache write failed: {e}")
+
+
+def _to_subs(data: SubscriptionList) -> list[Sub]:
+    subs = []
+    for i, s in enumerate(data.subscriptions):
+        freq = s.frequency.lower()
+        mfac, yfac = FREQ_FACTORS.get(freq, FREQ_FACTORS["weekly"])
+        subs.append(Sub(
+            id=f"s{i}", name=s.name, amount=s.amount, frequency=freq,
+            last_charged=s.last_charged, count=s.count,
+            monthly=round(s.amount*mfac, 2), yearly=round(s.amount*yfac, 2),
+            cancel_url=s.cancel_url
+        ))
+    return subs
+
+
+def _extract_pages(pdf: pymupdf.Document) -> str:
+    """Plain text only: no image/vector collection (see TEXT_FLAGS), no get_drawings()/get_images()/dict modes"""
+    text = ""
+    for page in pdf:
+        text += page.get_text("text", flags=TEXT_FLAGS) + "\n"
+        if len(text) >= RAW_CHARS: break  # even compacted, the rest wouldn't fit in MAX_CHARS
+    return text
+
+
+def _extract_text(file: BinaryIO, filename: str) -> str:
+    file.seek(0)
     if filename.lower().endswith('.pdf'):
-        text = ""
+        # MuPDF reads pages lazily from a path, so copy the upload to a named temp file in chunks
+        # instead of holding it in memory. Extraction is serial: a statement takes ~0.1s, and
+        # parse() already runs files in parallel threads
+        fd, path = tempfile.mkstemp(suffix=".pdf")
         try:
-            with pdfplumber.open(BytesIO(content)) as pdf:
-                for p in pdf.pages:
-                    if t := p.extract_text(): text += t + "\n"
-        except: pass
-    else:
-        try: text = content.decode('utf-8')
-        except: text = content.decode('latin-1')
-    
+            with os.fdopen(fd, "wb") as tmp: shutil.copyfileobj(file, tmp, CHUNK)
+            with pymupdf.open(path, filetype="pdf") as pdf:
+                if pdf.needs_pass: return ""  # opens fine, but get_text() raises "document closed or encrypted"
+                return _extract_pages(pdf)
+        except (RuntimeError, ValueError): return ""  # FileDataError and other MuPDF errors on damaged files
+        finally: os.unlink(path)
+    # Only read up to RAW_CHARS characters (utf-8 is at most 4 bytes per char)
+    raw = file.read(RAW_CHARS * 4)
+    try: return codecs.getincrementaldecoder('utf-8')().decode(raw, final=len(raw) < RAW_CHARS * 4)  # a cut-off trailing char isn't an error
+    except UnicodeDecodeError: return raw.decode('latin-1')
+
+
+def _compact(text: str) -> str:
+    """Keeps transaction-looking lines plus one line of context either side, with whitespace collapsed"""
+    lines = text.splitlines()
+    keep = set()
+    for i, line in enumerate(lines):
+        if TXN_LINE.search(line): keep.update((i - 1, i, i + 1))
+    kept = [line for i in sorted(keep) if 0 <= i < len(lines) and (line := " ".join(lines[i].split()))]
+    return "\n".join(kept) if kept else text  # nothing recognisable: let the model see the raw text
+
+
+def _merchant_hits(text: str) -> str:
+    """Summarises known-service lines, e.g. '- Netflix: 3 charges, amounts 15.99, 15.99, 15.99'"""
+    hits: dict[str, list[str]] = {}
+    for line in text.splitlines():
+        if m := MERCHANTS.search(line):
+            amounts = hits.setdefault(_SERVICE_NAMES[int(m.lastgroup[1:])], [])
+            if a := AMOUNT.search(line, m.end()): amounts.append(a.group())
+            else: amounts.append("?")  # amount is in another column/line
+    # Only the first few amounts per service: a long history would otherwise repeat the statement itself
+    return "\n".join(f"- {name}: {len(a)} charges, amounts {', '.join(a[:HIT_AMOUNTS])}{', ...' if len(a) > HIT_AMOUNTS else ''}"
+                     for name, a in hits.items())
+
+
+async def _llm_call(text: str, api_key: str) -> SubscriptionList:
+    statement = _compact(text)[:MAX_CHARS]
+    content = f"Bank statement:\n{statement}"
+    if hits := _merchant_hits(statement):  # only what the model can actually see and confirm
+        content = f"Pre-detected known services (regex scan; confirm against the statement and still look for others):\n{hits}\n\n" + content
+
+    # PROMPT goes first and unchanged in its own message so providers with prefix caching can reuse it
+    messages = [{"role": "system", "content": PROMPT}, {"role": "user", "content": content}]
+    for attempt in range(LLM_ATTEMPTS):
+        # Use structured outputs with Pydantic schema
+        body = orjson.dumps({
+            "model": MODEL,
+            "messages": messages,
+            "temperature": 0.1,
+            "max_tokens": 8000,
+            "response_format": _SUBS_SCHEMA
+        })
+        resp = await app.state.http.post(OPENROUTER_URL, content=body, headers={
+            "Authorization": f"Bearer {api_key}", "Content-Type": "application/json"
+        })
+        resp.raise_for_status()
+        
+        # Parse with Pydantic validation; on failure show the model its own output and the error
+        result = orjson.loads(resp.content)["choices"][0]["message"]["content"].strip()
+        try: return SubscriptionList.model_validate_json(result)
+        except ValidationError as e:
+            if attempt == LLM_ATTEMPTS - 1: raise
+            print(f"Invalid LLM output (attempt {attempt + 1}/{LLM_ATTEMPTS}), retrying: {e.error_count()} errors")
+            messages += [
+                {"role": "assistant", "content": result},
+                {"role": "user", "content": f"Your output had error: {e}. Fix and retry returning only valid JSON."},
+            ]
+            await asyncio.sleep(1.0 * (attempt + 1))
+
+
+async def parse(file: BinaryIO, filename: str) -> list[Sub] | str:
+    """Returns list of subscriptions, or error string"""
+    # Hashing, cache I/O and PDF extraction block on file I/O and CPU: keep them off the event loop
+    key = await asyncio.to_thread(_cache_key, file)
+    if cached := await asyncio.to_thread(_cache_get, key): return _to_subs(cached)
+
+    text = await asyncio.to_thread(_extract_text, file, filename)
     if not text.strip(): return "Could not read file contents"
+    if not os.getenv("STRICT_LLM") and not (MERCHANTS.search(text) or BRANDS.search(text) or RECURRING.search(text)):
+        print(f"{filename}: no known merchants, skipping LLM")
+        return []
     
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key: return "OPENROUTER_API_KEY not set. Run: export OPENROUTER_API_KEY='your-key'"
     
     try:
-        with OpenRouter(api_key=api_key) as client:
-            # Use structured outputs with Pydantic schema
-            resp = client.chat.send(
-                model="google/gemini-2.0-flash-001",
-                messages=[{"role": "user", "content": PROMPT + text[:50000]}],
-                temperature=0.1,
-                max_tokens=8000,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "subscriptions",
-                        "strict": True,
-                        "schema": SubscriptionList.model_json_schema()
-                    }
-                }
-            )
-            
-            # Parse with Pydantic validation
-            result = resp.choices[0].message.content.strip()
-            data = SubscriptionList.model_validate_json(result)
-            
-            subs = []
-            for i, s in enumerate(data.subscriptions):
-                freq = s.frequency.lower()
-                monthly = s.amount if freq == "monthly" else s.amount/12 if freq == "yearly" else s.amount*4.33
-                yearly = s.amount*12 if freq == "monthly" else s.amount if freq == "yearly" else s.amount*52
-                subs.append(Sub(
-                    id=f"s{i}", name=s.name, amount=s.amount, frequency=freq,
-                    last_charged=s.last_charged, count=s.count,
-                    monthly=round(monthly, 2), yearly=round(yearly, 2),
-                    cancel_url=s.cancel_url
-                ))
-            return subs
+        data = await _llm_call(text, api_key)
     except Exception as e:
         print(f"Error: {e}")
         return []
+    await asyncio.to_thread(_cache_put, key, data)
+    return _to_subs(data)
+
+
+async def _save_session(sid: str, subs: list[Sub]):
+    if store: await store.set(f"sess:{sid}", orjson.dumps([{k: getattr(s, k) for k in _SESSION_FIELDS} for s in subs]), ex=SESSION_TTL)
+    else: sessions[sid] = subs
+
+
+@lru_cache(maxsize=1)
+def _index_shell(template) -> str:
+    """Empty landing page with a {SID} placeholder; keyed on the template so auto-reloaded edits re-render"""
+    return template.render(sid="{SID}")
 
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    sid = str(uuid.uuid4())
-    sessions[sid] = []
-    return templates.TemplateResponse("index.html", {"request": request, "sid": sid})
+    sid = str(uuid.uuid4())  # the session itself is only written once upload() has results
+    return HTMLResponse(_index_shell(templates.get_template("index.html")).replace("{SID}", sid))
 
 
 @app.post("/upload", response_class=HTMLResponse)
 async def upload(request: Request, files: list[UploadFile] = File(...), sid: str = Form(...)):
+    # LLM round-trips overlap, so K files cost ~one call's latency instead of K.
+    # Each f.file is the spooled temp file Starlette already wrote the upload to, so it's read in chunks
+    results = await asyncio.gather(*(parse(f.file, f.filename) for f in files))
     subs = []
-    for f in files:
-        result = parse(await f.read(), f.filename)
+    for result in results:
         if isinstance(result, str):  # Error message
             return templates.TemplateResponse("index.html", {"request": request, "sid": sid, "error": result})
         subs.extend(result)
     if not subs:
         return templates.TemplateResponse("index.html", {"request": request, "sid": sid, "error": "No subscriptions found"})
-    sessions[sid] = subs
+    await _save_session(sid, subs)
+    total_monthly = total_yearly = 0.0
+    for s in subs:  # one pass for both totals
+        total_monthly += s.monthly
+        total_yearly += s.yearly
     return templates.TemplateResponse("index.html", {
         "request": request, "sid": sid, "subs": subs,
-        "total_monthly": round(sum(s.monthly for s in subs), 2),
-        "total_yearly": round(sum(s.yearly for s in subs), 2)
+        "total_monthly": f"{total_monthly:,.2f}", "total_yearly": f"{total_yearly:,.2f}"
     })
 
 
@@ -148,4 +365,8 @@ if __name__ == "__main__":
     if not os.getenv("OPENROUTER_API_KEY"):
         print("⚠️  Set OPENROUTER_API_KEY first!")
     print("🚀 http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "backend:app", host="0.0.0.0", port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools", workers=WORKERS
+    )